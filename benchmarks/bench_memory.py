@@ -0,0 +1,117 @@
+"""Report peak memory while serving concurrent searches against a mock upstream
+
+Compares the bounded streaming path against reading whole bodies with
+`response.json()` and holding them through formatting.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_memory.py [concurrency] [padding_kb]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+os.environ.setdefault("BRAVE_API_KEY", "benchmark")
+
+from mcp_brave_search.server import BraveSearchServer
+
+CHUNK_BYTES = 64 * 1024
+
+
+def make_payload(padding_kb: int) -> bytes:
+    """Build a web search body padded with sections the server discards"""
+    results = [
+        {
+            "title": f"Result {i}",
+            "description": "Benchmark result " * 10,
+            "url": f"https://example.com/{i}",
+        }
+        for i in range(20)
+    ]
+    padding = [{"blob": "x" * 1024} for _ in range(padding_kb)]
+    return json.dumps(
+        {"web": {"results": results}, "videos": {"results": padding}}
+    ).encode()
+
+
+def make_server(payload: bytes) -> BraveSearchServer:
+    """Create a server whose upstream streams `payload` in chunks"""
+    async def stream():
+        for start in range(0, len(payload), CHUNK_BYTES):
+            # Yield so concurrent responses overlap like real network reads
+            await asyncio.sleep(0)
+            yield payload[start:start + CHUNK_BYTES]
+
+    server = BraveSearchServer(os.environ["BRAVE_API_KEY"])
+    server.rate_limit.per_second = 1_000_000
+    server._client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, content=stream()))
+    )
+    return server
+
+
+async def bounded_search(server: BraveSearchServer, query: str) -> str:
+    results = await server._get_web_results(query, 20)
+    await asyncio.sleep(0)  # Formatting runs while other searches are in flight
+    return server._format_web_results({"web": {"results": results}}, 20)
+
+
+async def baseline_search(server: BraveSearchServer, query: str) -> str:
+    """Whole-body read as before size caps were added"""
+    response = await server.get_client().get(
+        f"{server.base_url}/web/search",
+        params={"q": query, "count": 20}
+    )
+    response.raise_for_status()
+    data = response.json()
+    await asyncio.sleep(0)
+    return server._format_web_results(data, 20)
+
+
+async def measure(search, concurrency: int, payload: bytes):
+    server = make_server(payload)
+    tracemalloc.start()
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(search(server, f"query {i}") for i in range(concurrency)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    failed = sum(isinstance(r, Exception) for r in results)
+    return elapsed, peak, failed, server.payload_budget
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    padding_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    payload = make_payload(padding_kb)
+
+    print(f"concurrency {concurrency}, response size {len(payload) / 1024:.0f} KiB")
+    print(
+        f"{'path':<10}{'elapsed':>10}{'peak MiB':>10}"
+        f"{'claimed MiB':>13}{'read MiB':>10}{'failed':>8}"
+    )
+    for name, search in (("baseline", baseline_search), ("bounded", bounded_search)):
+        elapsed, peak, failed, budget = asyncio.run(
+            measure(search, concurrency, payload)
+        )
+        # The baseline bypasses the payload budget
+        if search is baseline_search:
+            claimed = read = "-"
+        else:
+            claimed = f"{budget.peak_claimed / 1024 / 1024:.1f}"
+            read = f"{budget.peak_read / 1024 / 1024:.1f}"
+        print(
+            f"{name:<10}{elapsed:>9.2f}s{peak / 1024 / 1024:>10.1f}"
+            f"{claimed:>13}{read:>10}{failed:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
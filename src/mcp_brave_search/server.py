@@ -4,8 +4,13 @@ import time
 import asyncio
 import logging
 from typing import Optional, Dict, List, Any, Tuple
-from dataclasses import dataclass
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from enum import Enum
+import heapq
+import itertools
+import json
+import math
 import os
 import sys
 import io
@@ -28,35 +33,282 @@ if not api_key:
 else:
     logger.info(f"BRAVE_API_KEY found with length: {len(api_key)}")
 
+# Upstream requests each tool may issue, reserved up front by the scheduler
+WEB_SEARCH_COST = 2  # query plus the smaller-count retry on a 422
+LOCAL_SEARCH_COST = 5  # query, two pagination pages, POI and description lookups
+
+# Requests each tool cannot complete without, which must all start before its deadline
+WEB_SEARCH_REQUIRED = 1  # query
+LOCAL_SEARCH_REQUIRED = 3  # query, POI and description lookups
+
+# Caps on decoded upstream bodies, per response and across all in-flight responses
+MAX_RESPONSE_BYTES = int(os.getenv("BRAVE_MAX_RESPONSE_BYTES", 2 * 1024 * 1024))
+MEMORY_BUDGET_BYTES = int(os.getenv("BRAVE_MEMORY_BUDGET_BYTES", 64 * 1024 * 1024))
+
 class RateLimitError(Exception):
+    def __init__(
+        self,
+        message: str = "Rate limit exceeded",
+        retry_after_ms: Optional[int] = None
+    ):
+        super().__init__(message)
+        self.retry_after_ms = retry_after_ms
+
+class ResponseTooLargeError(Exception):
     pass
 
+@dataclass
+class PayloadBudget:
+    max_bytes: int = MEMORY_BUDGET_BYTES
+    max_wait: float = 5.0
+    peak_claimed: int = 0
+    peak_read: int = 0
+    _claimed: int = 0
+    _read: int = 0
+    _released: asyncio.Condition = field(default_factory=asyncio.Condition)
+
+    async def acquire(self, size: int):
+        """Claim `size` bytes, waiting for in-flight responses to release theirs"""
+        if size > self.max_bytes:
+            raise ResponseTooLargeError(
+                f"Response claim of {size} bytes exceeds the {self.max_bytes} byte budget"
+            )
+        async with self._released:
+            try:
+                await asyncio.wait_for(
+                    self._released.wait_for(
+                        lambda: self._claimed + size <= self.max_bytes
+                    ),
+                    self.max_wait
+                )
+            except asyncio.TimeoutError:
+                raise RateLimitError(
+                    "In-flight response memory budget exhausted",
+                    retry_after_ms=math.ceil(self.max_wait * 1000)
+                )
+            self._claimed += size
+            self.peak_claimed = max(self.peak_claimed, self._claimed)
+
+    def record_read(self, size: int):
+        """Track body bytes actually held, which stay within the claims"""
+        self._read += size
+        self.peak_read = max(self.peak_read, self._read)
+
+    async def release(self, size: int, read: int = 0):
+        """Return a claim of `size` bytes along with the `read` bytes held under it"""
+        async with self._released:
+            self._claimed -= size
+            self._read -= read
+            self._released.notify_all()
+
 @dataclass
 class RateLimit:
     per_second: int = 1
     per_month: int = 2000
     _requests: Dict[str, int] = None
-    _last_reset: float = 0.0
+    _next_slot: float = 0.0
 
     def __post_init__(self):
-        self._requests = {"second": 0, "month": 0}
-        self._last_reset = time.time()
-
-    def check(self):
-        now = time.time()
-        if now - self._last_reset > 1:
-            self._requests["second"] = 0
-            self._last_reset = now
-        
-        if (self._requests["second"] >= self.per_second or 
-            self._requests["month"] >= self.per_month):
-            raise RateLimitError("Rate limit exceeded")
-        
-        self._requests["second"] += 1
-        self._requests["month"] += 1
+        self._requests = {"month": 0}
+        self._next_slot = time.monotonic()
+
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.per_second
+
+    @property
+    def remaining(self) -> int:
+        return self.per_month - self._requests["month"]
+
+    def wait_time(self) -> float:
+        """Seconds until the next per-second slot is free"""
+        return max(0.0, self._next_slot - time.monotonic())
+
+    def reserve(self, cost: int) -> Tuple[List[float], float]:
+        """Book `cost` consecutive request slots
+
+        Returns the slot start times and the end of the booking, which
+        `release` uses to tell whether anything was booked after it.
+        """
+        if cost > self.remaining:
+            raise RateLimitError("Monthly quota exhausted")
+        start = max(time.monotonic(), self._next_slot)
+        slots = [start + i * self.interval for i in range(cost)]
+        self._next_slot = start + cost * self.interval
+        self._requests["month"] += cost
+        return slots, self._next_slot
+
+    def release(self, slots: List[float], end: float):
+        """Return unused trailing slots, reclaiming them if nothing was booked after `end`"""
+        if not slots:
+            return
+        self._requests["month"] -= len(slots)
+        if self._next_slot == end:
+            self._next_slot = max(time.monotonic(), slots[0])
+
+class Ticket:
+    """Request slots reserved for a single tool call"""
+
+    def __init__(
+        self,
+        rate_limit: RateLimit,
+        cost: int,
+        deadline: float = float("inf")
+    ):
+        self._rate_limit = rate_limit
+        self._slots, self._end = rate_limit.reserve(cost)
+        self._deadline = deadline
+
+    def can_issue(self, count: int) -> bool:
+        """Whether `count` more requests can start before the deadline"""
+        return len(self._slots) >= count and self._slots[count - 1] <= self._deadline
+
+    async def pace(self):
+        """Wait for the next reserved slot before issuing an upstream request"""
+        if not self._slots:
+            raise RateLimitError("Reserved request budget exhausted")
+        if self._slots[0] > self._deadline:
+            wait = self._slots[0] - time.monotonic()
+            raise RateLimitError(
+                "Deadline reached before the next request",
+                retry_after_ms=math.ceil(wait * 1000)
+            )
+        delay = self._slots.pop(0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def release(self):
+        self._rate_limit.release(self._slots, self._end)
+        self._slots = []
+
+@dataclass(order=True)
+class _Pending:
+    key: Tuple[int, float, int]
+    cost: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+class AdmissionScheduler:
+    """Admit tool calls against the rate limit by priority, then deadline
+
+    Each call reserves its whole request cost before it starts, so it cannot
+    run out of budget half-way. Calls whose required requests cannot all
+    start before their deadline are shed up front with a RateLimitError.
+    Optional requests, such as extra pages or retries, are refused by
+    `Ticket.pace` when they would start past the deadline.
+    """
+
+    def __init__(self, rate_limit: RateLimit, max_queue_delay: float = 10.0):
+        self.rate_limit = rate_limit
+        self.max_queue_delay = max_queue_delay
+        self._queue: List[_Pending] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _estimate_wait(self, key: Tuple[int, float, int]) -> float:
+        """Seconds until a call with `key` would be admitted"""
+        ahead = sum(p.cost for p in self._queue if p.key < key)
+        return self.rate_limit.wait_time() + ahead * self.rate_limit.interval
+
+    def _shed(self, wait: float) -> RateLimitError:
+        retry_after_ms = math.ceil(wait * 1000)
+        logger.warning(f"Shedding request, retry after {retry_after_ms} ms")
+        return RateLimitError(retry_after_ms=retry_after_ms)
+
+    def _release(self, ticket: Ticket):
+        ticket.release()
+        # Refunded slots may let queued calls in before the timer fires
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+
+    def _dispatch(self):
+        self._timer = None
+        while self._queue and self.rate_limit.wait_time() == 0:
+            pending = heapq.heappop(self._queue)
+            if pending.future.done():
+                continue
+            try:
+                ticket = Ticket(self.rate_limit, pending.cost, pending.key[1])
+            except RateLimitError as e:
+                pending.future.set_exception(e)
+                continue
+            pending.future.set_result(ticket)
+        if self._queue:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.rate_limit.wait_time(), self._dispatch
+            )
+
+    @asynccontextmanager
+    async def admit(
+        self,
+        cost: int,
+        priority: int = 0,
+        deadline_ms: Optional[int] = None,
+        required: Optional[int] = None
+    ):
+        """Reserve `cost` request slots, waiting behind higher-priority calls
+
+        Args:
+            cost: Upstream requests the call may issue
+            priority: Higher values are admitted first
+            deadline_ms: Time by which the call's required requests must start
+            required: Requests the call cannot complete without (defaults to `cost`)
+        """
+        if cost > self.rate_limit.remaining:
+            raise RateLimitError("Monthly quota exhausted")
+
+        deadline = float("inf") if deadline_ms is None else deadline_ms / 1000
+        # Required requests take the first slots; the last must start in time
+        spread = ((required or cost) - 1) * self.rate_limit.interval
+        if spread > deadline:
+            raise RateLimitError(
+                f"Deadline of {deadline_ms} ms is too short for this search; "
+                f"allow at least {math.ceil(spread * 1000)} ms"
+            )
+        key = (-priority, time.monotonic() + deadline, next(self._seq))
+        budget = min(self.max_queue_delay, deadline - spread)
+        wait = self._estimate_wait(key)
+        if wait > budget:
+            raise self._shed(wait)
+
+        if not self._queue and wait == 0:
+            ticket = Ticket(self.rate_limit, cost, key[1])
+        else:
+            pending = _Pending(key, cost, asyncio.get_running_loop().create_future())
+            heapq.heappush(self._queue, pending)
+            if self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(
+                    self.rate_limit.wait_time(), self._dispatch
+                )
+            try:
+                ticket = await asyncio.wait_for(asyncio.shield(pending.future), budget)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if pending.future.done() and not pending.future.cancelled():
+                    # Resolved just as we gave up; hand any slots back
+                    if pending.future.exception() is not None:
+                        raise pending.future.exception()
+                    self._release(pending.future.result())
+                else:
+                    pending.future.cancel()
+                    self._queue.remove(pending)
+                    heapq.heapify(self._queue)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                # Overtaken by higher-priority calls while queued
+                raise self._shed(self._estimate_wait(key))
+
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
 
 class BraveSearchServer:
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        max_response_bytes: int = MAX_RESPONSE_BYTES,
+        memory_budget_bytes: int = MEMORY_BUDGET_BYTES
+    ):
         # Configure stdout for UTF-8
         if sys.platform == 'win32':
             sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -68,6 +320,14 @@ class BraveSearchServer:
         self.api_key = api_key
         self.base_url = "https://api.search.brave.com/res/v1"
         self.rate_limit = RateLimit()
+        self.scheduler = AdmissionScheduler(self.rate_limit)
+        if max_response_bytes > memory_budget_bytes:
+            raise ValueError(
+                f"Maximum response size ({max_response_bytes} bytes) exceeds "
+                f"the in-flight memory budget ({memory_budget_bytes} bytes)"
+            )
+        self.max_response_bytes = max_response_bytes
+        self.payload_budget = PayloadBudget(memory_budget_bytes)
         self._client = None
         self._setup_tools()
 
@@ -83,51 +343,96 @@ class BraveSearchServer:
             )
         return self._client
 
-    async def _get_web_results(self, query: str, min_results: int) -> List[Dict]:
-        """Fetch web results with pagination until minimum count is reached"""
+    async def _fetch_json(
+        self,
+        path: str,
+        params: Dict[str, Any],
+        keep: Tuple[str, ...]
+    ) -> Dict[str, Any]:
+        """Stream a JSON response within the size caps, keeping only the `keep` path
+
+        Each response claims the per-response cap from the payload budget
+        before its request is sent, so a fetch never waits while holding part
+        of the budget or an open upstream connection. The claim is released
+        once the needed section has been pulled out, so only that section
+        outlives the call.
+        """
         client = self.get_client()
-        
+        await self.payload_budget.acquire(self.max_response_bytes)
+        body = bytearray()
         try:
-            self.rate_limit.check()
+            async with client.stream(
+                "GET",
+                f"{self.base_url}/{path}",
+                params=params
+            ) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    if len(body) + len(chunk) > self.max_response_bytes:
+                        raise ResponseTooLargeError(
+                            f"Response from {path} exceeds {self.max_response_bytes} bytes"
+                        )
+                    self.payload_budget.record_read(len(chunk))
+                    body += chunk
+            return self._extract_section(json.loads(body), keep)
+        finally:
+            await self.payload_budget.release(self.max_response_bytes, len(body))
+
+    def _extract_section(self, data: Any, keep: Tuple[str, ...]) -> Dict[str, Any]:
+        """Rebuild just the nested `keep` section of a response, dropping the rest"""
+        section = data
+        for key in keep:
+            if not isinstance(section, dict) or key not in section:
+                return {}
+            section = section[key]
+        for key in reversed(keep):
+            section = {key: section}
+        return section
+
+    async def _get_web_results(
+        self,
+        query: str,
+        min_results: int,
+        ticket: Optional[Ticket] = None
+    ) -> List[Dict]:
+        """Fetch web results with pagination until minimum count is reached"""
+        if ticket is None:
+            async with self.scheduler.admit(WEB_SEARCH_COST) as ticket:
+                return await self._get_web_results(query, min_results, ticket)
+
+        try:
+            await ticket.pace()
             logger.info(f"Executing web search query: '{query}' with count: {min_results}")
             
             # Make a single request with the maximum allowed count
-            response = await client.get(
-                f"{self.base_url}/web/search",
-                params={
-                    "q": query,
-                    "count": min_results
-                }
+            data = await self._fetch_json(
+                "web/search",
+                {"q": query, "count": min_results},
+                ("web", "results")
             )
-            response.raise_for_status()
-            data = response.json()
             results = data.get("web", {}).get("results", [])
             logger.info(f"Web search returned {len(results)} results")
             return results
             
-        except RateLimitError as e:
-            logger.warning(f"Rate limit exceeded: {str(e)}")
-            return [{"title": "Rate Limit Exceeded", 
-                   "description": "The search could not be completed due to rate limiting. Please try again later.", 
-                   "url": "#"}]
+        except (RateLimitError, ResponseTooLargeError):
+            raise
             
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 422:
                 # If we get a 422, try with a smaller count
                 logger.warning(f"Received 422 error, retrying with smaller count: {str(e)}")
                 try:
-                    response = await client.get(
-                        f"{self.base_url}/web/search",
-                        params={
-                            "q": query,
-                            "count": 10  # Fall back to smaller count
-                        }
+                    await ticket.pace()
+                    data = await self._fetch_json(
+                        "web/search",
+                        {"q": query, "count": 10},  # Fall back to smaller count
+                        ("web", "results")
                     )
-                    response.raise_for_status()
-                    data = response.json()
                     results = data.get("web", {}).get("results", [])
                     logger.info(f"Retry web search returned {len(results)} results")
                     return results
+                except (RateLimitError, ResponseTooLargeError):
+                    raise
                 except Exception as retry_error:
                     logger.error(f"Retry failed with error: {str(retry_error)}")
                     return []
@@ -166,120 +471,165 @@ class BraveSearchServer:
             
         return "\n\n".join(results)
 
+    def _format_rate_limited(self, error: RateLimitError) -> str:
+        """Format a shed request so callers know when to retry"""
+        if error.retry_after_ms is None:
+            return f"{error}."
+        return f"{error}. Retry after {error.retry_after_ms} ms."
+
+    async def _web_search(self, query: str, min_results: int, ticket: Ticket) -> str:
+        """Run a web search against an admitted ticket and format the results"""
+        all_results = await self._get_web_results(query, min_results, ticket)
+        
+        if not all_results:
+            return "No results found for the query."
+            
+        formatted_results = []
+        for result in all_results[:min_results]:
+            formatted_result = [
+                f"Title: {result.get('title', 'N/A')}",
+                f"Description: {result.get('description', 'N/A')}",
+                f"URL: {result.get('url', 'N/A')}"
+            ]
+            
+            # Include additional context if available
+            if result.get('extra_snippets'):
+                formatted_result.append("Additional Context:")
+                formatted_result.extend([f"- {snippet}" for snippet in result['extra_snippets'][:2]])
+                
+            formatted_results.append("\n".join(formatted_result))
+        
+        return "\n\n".join(formatted_results)
+
+    async def _local_search(self, query: str, ticket: Ticket) -> str:
+        """Run a local search against an admitted ticket and format the results"""
+        await ticket.pace()
+
+        # Initial location search
+        params = {
+            "q": query,
+            "search_lang": "en",
+            "result_filter": "locations",
+            "count": 20  # Always request maximum results
+        }
+
+        data = await self._fetch_json("web/search", params, ("locations", "results"))
+
+        location_ids = self._extract_location_ids(data)
+        if not location_ids:
+            # If no local results found, fallback to web search
+            # with minimum 10 results
+            return await self._web_search(query, 20, ticket)
+
+        # If we have less than 10 location IDs, try to get more
+        offset = 0
+        # Leave room for this page plus the POI and description lookups
+        try:
+            while len(location_ids) < 10 and offset < 40 and ticket.can_issue(3):
+                offset += 20
+                await ticket.pace()
+                additional_data = await self._fetch_json(
+                    "web/search",
+                    {**params, "offset": offset},
+                    ("locations", "results")
+                )
+                location_ids.extend(self._extract_location_ids(additional_data))
+        except (httpx.HTTPStatusError, ResponseTooLargeError, RateLimitError) as e:
+            # Extra pages are best effort; keep the locations already found
+            logger.warning(f"Location pagination stopped at offset {offset}: {str(e)}")
+
+        # Get details for at least 10 locations
+        pois, descriptions = await self._get_location_details(
+            location_ids[:max(10, len(location_ids))],
+            ticket
+        )
+        return self._format_local_results(pois, descriptions)
+
     def _setup_tools(self):
         @self.mcp.tool()
         async def brave_web_search(
             query: str,
-            count: Optional[int] = 20
+            count: Optional[int] = 20,
+            priority: Optional[int] = 0,
+            deadline_ms: Optional[int] = None
         ) -> str:
             """Execute web search using Brave Search API with improved results
             
             Args:
                 query: Search terms
                 count: Desired number of results (10-20)
+                priority: Scheduling priority when rate limited (higher runs first)
+                deadline_ms: Give up with a retry hint if requests can't start in time
             """
             min_results = max(10, min(count, 20))  # Ensure between 10 and 20
             
-            all_results = await self._get_web_results(query, min_results)
-            
-            if not all_results:
-                return "No results found for the query."
-                
-            formatted_results = []
-            for result in all_results[:min_results]:
-                formatted_result = [
-                    f"Title: {result.get('title', 'N/A')}",
-                    f"Description: {result.get('description', 'N/A')}",
-                    f"URL: {result.get('url', 'N/A')}"
-                ]
-                
-                # Include additional context if available
-                if result.get('extra_snippets'):
-                    formatted_result.append("Additional Context:")
-                    formatted_result.extend([f"- {snippet}" for snippet in result['extra_snippets'][:2]])
-                    
-                formatted_results.append("\n".join(formatted_result))
-            
-            return "\n\n".join(formatted_results)
+            try:
+                async with self.scheduler.admit(
+                    WEB_SEARCH_COST,
+                    priority or 0,
+                    deadline_ms,
+                    required=WEB_SEARCH_REQUIRED
+                ) as ticket:
+                    return await self._web_search(query, min_results, ticket)
+            except RateLimitError as e:
+                return self._format_rate_limited(e)
+            except ResponseTooLargeError as e:
+                return f"Search aborted: {e}."
 
         @self.mcp.tool()
         async def brave_local_search(
             query: str,
-            count: Optional[int] = 20
+            count: Optional[int] = 20,
+            priority: Optional[int] = 0,
+            deadline_ms: Optional[int] = None
         ) -> str:
             """Search for local businesses and places
             
             Args:
                 query: Location terms
                 count: Desired number of results (10-20)
+                priority: Scheduling priority when rate limited (higher runs first)
+                deadline_ms: Give up with a retry hint if requests can't start in time
             """
-            self.rate_limit.check()
-
-            # Initial location search
-            params = {
-                "q": query,
-                "search_lang": "en",
-                "result_filter": "locations",
-                "count": 20  # Always request maximum results
-            }
-
-            client = self.get_client()
-            response = await client.get(
-                f"{self.base_url}/web/search",
-                params=params
-            )
-            response.raise_for_status()
-            data = response.json()
-
-            location_ids = self._extract_location_ids(data)
-            if not location_ids:
-                # If no local results found, fallback to web search
-                # with minimum 10 results
-                return await brave_web_search(query, 20)
-
-            # If we have less than 10 location IDs, try to get more
-            offset = 0
-            while len(location_ids) < 10 and offset < 40:
-                offset += 20
-                additional_response = await client.get(
-                    f"{self.base_url}/web/search",
-                    params={
-                        "q": query,
-                        "search_lang": "en",
-                        "result_filter": "locations",
-                        "count": 20,
-                        "offset": offset
-                    }
-                )
-                additional_data = additional_response.json()
-                location_ids.extend(self._extract_location_ids(additional_data))
-
-            # Get details for at least 10 locations
-            pois, descriptions = await self._get_location_details(
-                location_ids[:max(10, len(location_ids))]
-            )
-            return self._format_local_results(pois, descriptions)
+            try:
+                async with self.scheduler.admit(
+                    LOCAL_SEARCH_COST,
+                    priority or 0,
+                    deadline_ms,
+                    required=LOCAL_SEARCH_REQUIRED
+                ) as ticket:
+                    return await self._local_search(query, ticket)
+            except RateLimitError as e:
+                return self._format_rate_limited(e)
+            except ResponseTooLargeError as e:
+                return f"Search aborted: {e}."
 
     async def _get_location_details(
         self,
-        ids: List[str]
+        ids: List[str],
+        ticket: Optional[Ticket] = None
     ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """Fetch POI and description data for locations"""
-        client = self.get_client()
-        pois_response, desc_response = await asyncio.gather(
-            client.get(
-                f"{self.base_url}/local/pois",
-                params={"ids": ids}
-            ),
-            client.get(
-                f"{self.base_url}/local/descriptions",
-                params={"ids": ids}
-            )
-        )
-        return (
-            pois_response.json(),
-            desc_response.json()
+        if ticket is None:
+            # One request each for POIs and descriptions
+            async with self.scheduler.admit(2) as ticket:
+                return await self._get_location_details(ids, ticket)
+
+        async def fetch(path: str, keep: str) -> Dict[str, Any]:
+            await ticket.pace()
+            return await self._fetch_json(f"local/{path}", {"ids": ids}, (keep,))
+
+        # Let both lookups finish before the ticket can be released
+        results = await asyncio.gather(
+            fetch("pois", "results"),
+            fetch("descriptions", "descriptions"),
+            return_exceptions=True
         )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        pois, descriptions = results
+        return pois, descriptions
 
     def _extract_location_ids(self, data: Dict) -> List[str]:
         """Extract location IDs from search response"""
@@ -2,6 +2,9 @@ import os
 import sys
 import pytest
 import asyncio
+import time
+import httpx
+import json
 from unittest.mock import patch, MagicMock
 
 # Add the parent directory to the Python path for importing
@@ -11,20 +14,30 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 os.environ['BRAVE_API_KEY'] = 'test_api_key_for_testing'
 
 # Import after setting the environment variable
-from src.mcp_brave_search.server import BraveSearchServer, RateLimitError
+from src.mcp_brave_search.server import (
+    LOCAL_SEARCH_COST,
+    LOCAL_SEARCH_REQUIRED,
+    AdmissionScheduler,
+    BraveSearchServer,
+    PayloadBudget,
+    RateLimit,
+    RateLimitError,
+    ResponseTooLargeError,
+)
 
 
-class MockResponse:
-    def __init__(self, json_data, status_code=200):
-        self.json_data = json_data
-        self.status_code = status_code
-    
-    def json(self):
-        return self.json_data
-    
-    def raise_for_status(self):
-        if self.status_code != 200:
-            raise Exception(f"HTTP Error: {self.status_code}")
+def mock_upstream(server, handler):
+    """Route the server's HTTP client through a mock transport."""
+    server._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def chunked(body, size=64):
+    """Stream a body in chunks, yielding to the event loop between them."""
+    async def stream():
+        for start in range(0, len(body), size):
+            await asyncio.sleep(0)
+            yield body[start:start + size]
+    return stream()
 
 
 @pytest.fixture
@@ -57,40 +70,236 @@ async def test_web_search_success(server):
         }
     }
     
-    # Mock httpx.AsyncClient.get
-    with patch('httpx.AsyncClient.get', return_value=MockResponse(mock_data)):
-        # Call the brave_web_search tool directly
-        results = await server._get_web_results("test query", 2)
-        
-        # Verify results
-        assert len(results) == 2
-        assert results[0]['title'] == "Test Result 1"
-        assert results[1]['title'] == "Test Result 2"
+    # Mock the upstream API
+    mock_upstream(server, lambda request: httpx.Response(200, json=mock_data))
+
+    # Call the brave_web_search tool directly
+    results = await server._get_web_results("test query", 2)
+    
+    # Verify results
+    assert len(results) == 2
+    assert results[0]['title'] == "Test Result 1"
+    assert results[1]['title'] == "Test Result 2"
 
 
 @pytest.mark.asyncio
 async def test_web_search_error_handling(server):
     """Test that web search handles errors gracefully."""
-    # Mock an HTTP error
-    with patch('httpx.AsyncClient.get', side_effect=Exception("Connection error")):
-        # Call the method directly
-        results = await server._get_web_results("test query", 2)
-        
-        # Verify error handling (should return empty list)
-        assert results == []
+    # Mock a connection error
+    def handler(request):
+        raise httpx.ConnectError("Connection error")
+
+    mock_upstream(server, handler)
+
+    # Call the method directly
+    results = await server._get_web_results("test query", 2)
+    
+    # Verify error handling (should return empty list)
+    assert results == []
+
+
+@pytest.mark.asyncio
+async def test_oversized_response_aborted(server):
+    """Test that responses over the size cap are aborted and their memory released."""
+    server.max_response_bytes = 1024
+    mock_upstream(
+        server,
+        lambda request: httpx.Response(200, content=b'{"web": {"results": [' + b" " * 4096 + b"]}}")
+    )
+
+    with pytest.raises(ResponseTooLargeError):
+        await server._get_web_results("test query", 2)
+
+    assert server.payload_budget._claimed == 0
+    assert server.payload_budget.peak_read <= 1024
+
+
+@pytest.mark.asyncio
+async def test_concurrent_fetches_wait_for_budget(server):
+    """Test that fetches contending for the memory budget wait their turn."""
+    body = json.dumps({"web": {"results": [{"title": "x" * 500}]}}).encode()
+    server.max_response_bytes = 1024
+    server.payload_budget = PayloadBudget(max_bytes=2048)
+    mock_upstream(server, lambda request: httpx.Response(200, content=chunked(body)))
+
+    results = await asyncio.gather(
+        *(server._fetch_json("web/search", {}, ("web", "results")) for _ in range(5))
+    )
+
+    assert all(r["web"]["results"][0]["title"] == "x" * 500 for r in results)
+    assert server.payload_budget.peak_claimed == 2048
+    assert server.payload_budget.peak_read <= 2 * len(body)
+    assert server.payload_budget._claimed == 0
+    assert server.payload_budget._read == 0
+
+
+@pytest.mark.asyncio
+async def test_exhausted_budget_sheds_with_retry_hint(server):
+    """Test that a fetch that can't get budget in time is told when to retry."""
+    server.max_response_bytes = 1024
+    server.payload_budget = PayloadBudget(max_bytes=1024, max_wait=0.05)
+    mock_get = MagicMock(return_value=httpx.Response(200, json={"web": {"results": []}}))
+    mock_upstream(server, mock_get)
+
+    await server.payload_budget.acquire(1024)
+    with pytest.raises(RateLimitError) as excinfo:
+        await server._fetch_json("web/search", {}, ("web", "results"))
+
+    # The budget is claimed before the request, so nothing was sent
+    assert excinfo.value.retry_after_ms == 50
+    mock_get.assert_not_called()
+
+
+def test_response_cap_must_fit_memory_budget():
+    """Test that a response cap larger than the whole budget fails at startup."""
+    with pytest.raises(ValueError):
+        BraveSearchServer(
+            os.environ['BRAVE_API_KEY'],
+            max_response_bytes=2048,
+            memory_budget_bytes=1024
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("failed_page", [
+    httpx.Response(500),
+    httpx.Response(200, content=b" " * 8192),
+])
+async def test_local_search_keeps_locations_when_pagination_fails(server, failed_page):
+    """Test that a failed extra page doesn't discard locations already found."""
+    def handler(request):
+        if request.url.path.endswith("/pois"):
+            return httpx.Response(200, json={"results": [{"id": "loc-1", "name": "Cafe"}]})
+        if request.url.path.endswith("/descriptions"):
+            return httpx.Response(200, json={"descriptions": {"loc-1": "Coffee"}})
+        if "offset" in request.url.params:
+            return failed_page
+        return httpx.Response(200, json={"locations": {"results": [{"id": "loc-1"}]}})
+
+    server.rate_limit.per_second = 100
+    server.max_response_bytes = 4096
+    mock_upstream(server, handler)
+
+    async with server.scheduler.admit(LOCAL_SEARCH_COST) as ticket:
+        formatted = await server._local_search("coffee", ticket)
+
+    assert "Name: Cafe" in formatted
+    assert "Description: Coffee" in formatted
+
+
+@pytest.mark.asyncio
+async def test_fetch_keeps_only_needed_section(server):
+    """Test that only the requested result array survives parsing."""
+    mock_data = {
+        "query": {"original": "coffee"},
+        "web": {"results": [{"title": "Unused"}]},
+        "locations": {"results": [{"id": "loc-1"}], "type": "locations"}
+    }
+    mock_upstream(server, lambda request: httpx.Response(200, json=mock_data))
+
+    data = await server._fetch_json("web/search", {"q": "coffee"}, ("locations", "results"))
+
+    assert data == {"locations": {"results": [{"id": "loc-1"}]}}
+    assert await server._fetch_json("web/search", {}, ("mixed", "results")) == {}
 
 
 @pytest.mark.asyncio
 async def test_rate_limit_handling(server):
-    """Test that rate limit errors are handled properly."""
-    # Mock a rate limit error with the correct RateLimitError class
-    with patch.object(server.rate_limit, 'check', side_effect=RateLimitError("Rate limit exceeded")):
-        # Call the method directly
-        results = await server._get_web_results("test query", 2)
-        
-        # Verify proper error handling response
-        assert len(results) == 1
-        assert "Rate Limit" in results[0]['title']
+    """Test that saturated rate limits shed load with a retry hint."""
+    # Book the per-second budget well past the scheduler's queueing limit
+    server.rate_limit._next_slot = time.monotonic() + 30
+
+    with patch('httpx.AsyncClient.stream') as mock_stream:
+        with pytest.raises(RateLimitError) as excinfo:
+            await server._get_web_results("test query", 2)
+
+    # Verify no request was sent and the caller is told when to retry
+    mock_stream.assert_not_called()
+    assert excinfo.value.retry_after_ms >= 29000
+    assert "Retry after" in server._format_rate_limited(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_admits_by_priority():
+    """Test that queued calls are admitted by priority, then deadline."""
+    scheduler = AdmissionScheduler(RateLimit(per_second=50))
+    admitted = []
+
+    async def call(name, **kwargs):
+        async with scheduler.admit(1, **kwargs):
+            admitted.append(name)
+
+    scheduler.rate_limit._next_slot = time.monotonic() + 0.05
+    await asyncio.gather(
+        call("low"),
+        call("late", priority=1, deadline_ms=5000),
+        call("early", priority=1, deadline_ms=1000),
+    )
+
+    assert admitted == ["early", "late", "low"]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_reserves_whole_cost():
+    """Test that admission reserves every request up front and refunds the rest."""
+    rate_limit = RateLimit(per_second=10, per_month=10)
+    scheduler = AdmissionScheduler(rate_limit)
+
+    async with scheduler.admit(LOCAL_SEARCH_COST) as ticket:
+        assert rate_limit.remaining == 10 - LOCAL_SEARCH_COST
+        await ticket.pace()
+
+    # Only the one request actually issued stays charged, and its unused
+    # slots are free again
+    assert rate_limit.remaining == 9
+    assert rate_limit.wait_time() <= rate_limit.interval
+
+
+@pytest.mark.asyncio
+async def test_scheduler_sheds_requests_past_deadline():
+    """Test that deadlines cover every required request before any is sent."""
+    rate_limit = RateLimit(per_second=10)
+    scheduler = AdmissionScheduler(rate_limit)
+
+    # The POI and description lookups can't start in time, so nothing is spent
+    with pytest.raises(RateLimitError) as excinfo:
+        async with scheduler.admit(
+            LOCAL_SEARCH_COST, deadline_ms=190, required=LOCAL_SEARCH_REQUIRED
+        ):
+            pass
+    assert "at least 200 ms" in str(excinfo.value)
+    assert rate_limit.remaining == rate_limit.per_month
+
+    async with scheduler.admit(
+        LOCAL_SEARCH_COST, deadline_ms=250, required=LOCAL_SEARCH_REQUIRED
+    ) as ticket:
+        await ticket.pace()
+        # No room for an optional extra page ahead of the two required lookups
+        assert not ticket.can_issue(3)
+        await ticket.pace()
+        await ticket.pace()
+
+        # Optional requests past the deadline are still refused
+        with pytest.raises(RateLimitError):
+            await ticket.pace()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_admits_queued_calls_at_interval():
+    """Test that refunded slots let queued calls in at the rate-limit interval."""
+    scheduler = AdmissionScheduler(RateLimit(per_second=10))
+    admitted = []
+
+    async def call():
+        # Reserve for a retry that never happens, like a web search
+        async with scheduler.admit(2) as ticket:
+            await ticket.pace()
+            admitted.append(time.monotonic())
+
+    await asyncio.gather(*(call() for _ in range(6)))
+
+    gaps = [later - earlier for earlier, later in zip(admitted, admitted[1:])]
+    assert max(gaps) < 0.15
 
 
 def test_format_results(server):